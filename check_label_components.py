@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Checks raw2swc.label_components against a plain per-root BFS over sorted
+# children, the order every exported SWC is written in. Run it after any change
+# to label_components, climb_to_roots, subtree_sizes or build_child_csr:
+#
+#   python check_label_components.py --trials 200
+import argparse
+import sys
+from collections import deque
+from typing import List
+
+import numpy as np
+
+from raw2swc import build_child_csr, label_components
+
+def reference_bfs(parent_row: np.ndarray, roots: np.ndarray) -> List[List[int]]:
+    children: List[List[int]] = [[] for _ in range(len(parent_row))]
+    for row, parent in enumerate(parent_row.tolist()):
+        if parent != -1:
+            children[parent].append(row)
+
+    out = []
+    for root in roots.tolist():
+        order = []
+        q = deque([root])
+        seen = set()
+        while q:
+            u = q.popleft()
+            if u in seen:
+                continue
+            seen.add(u)
+            order.append(u)
+            for v in sorted(children[u]):
+                if v not in seen:
+                    q.append(v)
+        out.append(order)
+    return out
+
+def random_forest(rng: np.random.Generator) -> np.ndarray:
+    # parent_row for a random forest whose rows are shuffled, so parents are
+    # not always on earlier rows. Some trials are deep chains or wide fans,
+    # and some add parent cycles, which no root reaches.
+    n = int(rng.integers(1, 400))
+    shape = rng.choice(["random", "chain", "fan"])
+    parent_at = np.full(n, -1, dtype=np.int64)
+    for k in range(1, n):
+        if rng.random() < 0.05:
+            continue
+        if shape == "chain":
+            parent_at[k] = k - 1
+        elif shape == "fan":
+            parent_at[k] = int(rng.integers(0, min(k, 3)))
+        else:
+            parent_at[k] = int(rng.integers(0, k))
+
+    perm = rng.permutation(n)
+    parent_row = np.full(n, -1, dtype=np.int32)
+    has_parent = parent_at != -1
+    parent_row[perm[has_parent]] = perm[parent_at[has_parent]]
+
+    if n > 3 and rng.random() < 0.3:
+        cycle = rng.choice(n, size=int(rng.integers(1, 4)), replace=False)
+        parent_row[cycle] = np.roll(cycle, 1)
+    return parent_row
+
+def main():
+    ap = argparse.ArgumentParser(description="Compare label_components with a per-root BFS")
+    ap.add_argument("--trials", type=int, default=200, help="Random forests to check")
+    ap.add_argument("--seed", type=int, default=0, help="Seed for the random forests")
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    for trial in range(args.trials):
+        parent_row = random_forest(rng)
+        indptr, indices = build_child_csr(parent_row)
+        roots = np.flatnonzero(parent_row == -1).astype(np.int32)
+        root_of, root_indptr, members = label_components(parent_row, indptr, indices, roots)
+
+        expected = reference_bfs(parent_row, roots)
+        got = [members[root_indptr[ri]:root_indptr[ri + 1]].tolist() for ri in range(len(roots))]
+        expected_root_of = np.full(len(parent_row), -1, dtype=np.int64)
+        for ri, order in enumerate(expected):
+            expected_root_of[order] = ri
+        if got != expected or not np.array_equal(root_of, expected_root_of):
+            print(f"Mismatch in trial {trial}: parent_row={parent_row.tolist()}")
+            sys.exit(1)
+
+    print(f"{args.trials} forests match the per-root BFS")
+
+if __name__ == "__main__":
+    main()
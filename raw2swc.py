@@ -1,112 +1,332 @@
 #!/usr/bin/env python3
 import os
+import io
+import mmap
 import argparse
 import csv
 import math
+import itertools
+import threading
+import zipfile
 from typing import Dict, List, Tuple, Optional
-from collections import defaultdict, deque
-
-def parse_giant_swc(path: str):
-    nodes: Dict[int, Tuple[float, float, float, float, int, int]] = {}
-    children: Dict[int, List[int]] = defaultdict(list)
-    roots: List[int] = []
-
-    with open(path, "r") as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            parts = line.split()
-            if len(parts) < 7:
-                continue
-
-            nid = int(parts[0])
-            ntype = int(float(parts[1]))
-            x = float(parts[2])
-            y = float(parts[3])
-            z = float(parts[4])
-            r = float(parts[5])
-            parent = int(parts[6])
-
-            nodes[nid] = (x, y, z, r, ntype, parent)
-
-    for nid, (x, y, z, r, ntype, parent) in nodes.items():
-        if parent == -1:
-            # Start of a fragement. Potential root.
-            roots.append(nid)
-        else:
-            if parent in nodes:
-                children[parent].append(nid)
-            else:
-                # No parent. Could still be root.
-                roots.append(nid)
-
-    roots = sorted(set(roots))
-    return nodes, children, roots
-
-def extract_subtree(children: Dict[int, List[int]], root: int) -> List[int]:
-    # BFS from every child
-    out = []
-    q = deque([root])
-    seen = set()
-    while q:
-        u = q.popleft()
-        if u in seen:
-            continue
-        seen.add(u)
-        out.append(u)
-        for v in children.get(u, []):
-            if v not in seen:
-                q.append(v)
-    return out
-
-def write_swc_for_root(
-    out_path: str,
-    nodes,
-    children,
-    root_id: int,
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    # numba is optional; anchor_hits falls back to NumPy without it
+    njit = None
+
+SWC_COLUMNS = ["id", "type", "x", "y", "z", "r", "parent"]
+
+# id and parent are parsed as exact int64 so that ids above 2**53 survive.
+# Short lines leave missing values, which int64 cannot hold; the file is then
+# re-read with the nullable Int64 dtype so those lines can be dropped. type
+# may be written as a float and is truncated after parsing.
+SWC_DTYPES = {
+    "id": np.int64,
+    "type": np.float64,
+    "x": np.float64,
+    "y": np.float64,
+    "z": np.float64,
+    "r": np.float64,
+    "parent": np.int64,
+}
+SWC_NULLABLE_DTYPES = {**SWC_DTYPES, "id": "Int64", "parent": "Int64"}
+
+# Arrays returned by parse_giant_swc, in order
+SWC_INDEX_FIELDS = ("ids", "ntype", "xyz", "r", "parent_row", "indptr", "indices", "roots")
+# Stored in the --index_cache stamp. Bump it whenever parse_giant_swc's output
+# changes so caches written by older versions are rebuilt instead of reused.
+SWC_INDEX_VERSION = 3
+
+# Row format of exported SWCs
+SWC_FMT = "%d %d %.4f %.4f %.4f %.4f %d"
+
+# Inputs at least this large are parsed in parallel chunks
+PARALLEL_PARSE_BYTES = 64 << 20
+
+# Upper bound on the (nodes x anchors x 3) intermediate built by anchor_hits,
+# sized to stay within a typical L2 cache.
+CHUNK_BYTES = 1 << 20
+
+# Most nodes anchor_hits tests per block before checking for early exit
+HIT_BLOCK_NODES = 256
+
+# Roots handed to process_roots at a time
+ROOT_BLOCK = 64
+
+# Threads flushing exports in each process, and the most payloads that may be
+# queued for them at once
+WRITE_THREADS = 4
+MAX_PENDING_WRITES = 64
+
+NEIGHBOR_OFFSETS = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=np.int64)
+
+def read_swc_table(source) -> pd.DataFrame:
+    def read(dtypes):
+        return pd.read_csv(
+            source,
+            sep=r"\s+",
+            comment="#",
+            header=None,
+            names=SWC_COLUMNS,
+            usecols=range(len(SWC_COLUMNS)),
+            dtype=dtypes,
+            engine="c",
+            # The default fast float parser can be 1 ulp off Python's float(),
+            # enough to move a node across an inclusive cube face
+            float_precision="round_trip",
+        )
+
+    try:
+        try:
+            return read(SWC_DTYPES)
+        except ValueError:
+            if hasattr(source, "seek"):
+                source.seek(0)
+            return read(SWC_NULLABLE_DTYPES)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=SWC_COLUMNS).astype(SWC_DTYPES)
+
+def read_swc_range(path: str, start: int, end: int) -> pd.DataFrame:
+    # Parses bytes [start, end) of the file; runs in a worker process.
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return read_swc_table(io.BytesIO(mm[start:end]))
+
+def line_aligned_bounds(path: str, n_chunks: int) -> List[int]:
+    # Splits the file into roughly equal byte ranges that end on a newline
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        bounds = [0]
+        for target in np.linspace(0, size, n_chunks + 1)[1:-1].astype(np.int64).tolist():
+            nl = mm.find(b"\n", max(target, bounds[-1]))
+            if nl == -1:
+                break
+            bounds.append(nl + 1)
+        if bounds[-1] < size:
+            bounds.append(size)
+    return bounds
+
+def parse_giant_swc(path: str, workers: int = 1):
+    if workers > 1 and os.path.getsize(path) >= PARALLEL_PARSE_BYTES:
+        bounds = line_aligned_bounds(path, workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(read_swc_range, itertools.repeat(path), bounds[:-1], bounds[1:]))
+        df = pd.concat(parts, ignore_index=True)
+    else:
+        df = read_swc_table(path)
+    # Lines with fewer than 7 fields come back padded with missing values, which
+    # always leaves parent missing. Other columns may legitimately hold nan.
+    df = df.dropna(subset=["parent"])
+
+    # Rows are kept in node id order so that row order matches id order. A
+    # repeated id keeps its last line, as a later definition overrides.
+    df = df.sort_values("id", kind="stable").drop_duplicates("id", keep="last")
+    ids_arr = df["id"].to_numpy(np.int64)
+    ntype = df["type"].to_numpy(np.float64).astype(np.int32)
+    xyz = np.ascontiguousarray(df[["x", "y", "z"]].to_numpy(np.float64))
+    r = df["r"].to_numpy(np.float64)
+    parent_ids = df["parent"].to_numpy(np.int64)
+
+    # -1 marks nodes without a parent in the file
+    pos = np.minimum(np.searchsorted(ids_arr, parent_ids), max(len(ids_arr) - 1, 0))
+    found = (parent_ids != -1) & (ids_arr[pos] == parent_ids)
+    parent_row = np.where(found, pos, -1).astype(np.int32)
+
+    indptr, indices = build_child_csr(parent_row)
+    # Nodes with parent -1 start a fragment; orphans whose parent is missing
+    # from the file could still be roots. flatnonzero yields them sorted and
+    # unique, so no separate dedupe pass is needed.
+    roots = np.flatnonzero(parent_row == -1).astype(np.int32)
+    return ids_arr, ntype, xyz, r, parent_row, indptr, indices, roots
+
+def read_index_cache(cache_path: str, stamp: np.ndarray) -> Optional[tuple]:
+    # Returns the cached index, or None if the cache is stale, incomplete or
+    # unreadable (e.g. truncated by an interrupted run).
+    try:
+        with np.load(cache_path) as cached:
+            if not np.array_equal(cached["source_stamp"], stamp):
+                return None
+            return tuple(cached[name] for name in SWC_INDEX_FIELDS)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return None
+
+def write_index_cache(cache_path: str, stamp: np.ndarray, index: tuple):
+    # Written to a temporary file next to the cache and moved into place, so an
+    # interrupted run never leaves a partial cache behind.
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, source_stamp=stamp, **dict(zip(SWC_INDEX_FIELDS, index)))
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def load_swc_index(path: str, workers: int = 1, cache_path: Optional[str] = None):
+    # parse_giant_swc, optionally backed by an .npz cache so that reruns with
+    # updated anchors skip parsing. The cache is tied to SWC_INDEX_VERSION and
+    # the input's size and mtime, and is rebuilt whenever those change.
+    stat = os.stat(path)
+    stamp = np.array([SWC_INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    if cache_path and os.path.exists(cache_path):
+        index = read_index_cache(cache_path, stamp)
+        if index is not None:
+            return index
+
+    index = parse_giant_swc(path, workers)
+    if cache_path:
+        write_index_cache(cache_path, stamp, index)
+    return index
+
+def build_child_csr(parent_row: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Children of row u are indices[indptr[u]:indptr[u + 1]]. The stable sort
+    # over ascending child rows leaves every slice sorted, which is the order
+    # the exported BFS relies on.
+    n = len(parent_row)
+    child_rows = np.flatnonzero(parent_row != -1)
+    by_parent = np.argsort(parent_row[child_rows], kind="stable")
+    indices = child_rows[by_parent].astype(np.int32)
+    indptr = np.searchsorted(parent_row[indices], np.arange(n + 1)).astype(np.int32)
+    return indptr, indices
+
+def climb_to_roots(
+    parent_row: np.ndarray, values: np.ndarray, max_steps: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Pointer jumping up the parent links, doubling the hop length every step
+    # so that chains of depth D take log2(D) vectorized steps. Returns top,
+    # the topmost ancestor of every row (the row itself if it has no parent),
+    # the sum of values from each row up to and including top, and which rows
+    # finished within max_steps; rows on a parent cycle never do.
+    n = len(parent_row)
+    hop = parent_row.astype(np.int64)
+    top = np.arange(n, dtype=np.int64)
+    acc = values.astype(np.int64)
+    for _ in range(max_steps):
+        active = np.flatnonzero(hop != -1)
+        if not len(active):
+            break
+        # Synchronous update from the previous step's arrays
+        up = hop[active]
+        acc[active] = acc[active] + acc[up]
+        top[active] = top[up]
+        hop[active] = hop[up]
+    return top, acc, hop == -1
+
+def subtree_sizes(parent_row: np.ndarray) -> np.ndarray:
+    # Nodes in each row's subtree, itself included. After step j, size counts
+    # descendants closer than 2**j, and anc holds the ancestor exactly 2**j up.
+    # parent_row must be acyclic.
+    n = len(parent_row)
+    size = np.ones(n, dtype=np.int64)
+    anc = parent_row.astype(np.int64)
+    while True:
+        valid = np.flatnonzero(anc != -1)
+        if not len(valid):
+            return size
+        size = size + np.bincount(anc[valid], weights=size[valid], minlength=n).astype(np.int64)
+        nxt = np.full(n, -1, dtype=np.int64)
+        nxt[valid] = anc[anc[valid]]
+        anc = nxt
+
+def label_components(
+    parent_row: np.ndarray, indptr: np.ndarray, indices: np.ndarray, roots: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Returns root_of, where root_of[i] is the position in roots of the
+    # subtree containing row i (-1 if no root reaches it), and a CSR of
+    # subtree members: members[root_indptr[ri]:root_indptr[ri + 1]] is the
+    # subtree of roots[ri] in BFS order, root first.
+    #
+    # A BFS with sorted children visits one subtree level by level, and
+    # within a level in preorder (sorted-children DFS) order. So members are
+    # sorted by (root, depth, preorder index), where every step is a
+    # logarithmic pointer-jumping pass rather than one pass per tree level.
+    n = len(parent_row)
+    root_pos = np.full(n, -1, dtype=np.int32)
+    root_pos[roots] = np.arange(len(roots), dtype=np.int32)
+
+    top, depth, reached = climb_to_roots(parent_row, np.ones(n, dtype=np.int64), n.bit_length() + 1)
+    root_of = np.where(reached, root_pos[top], -1).astype(np.int32)
+    # Detach rows no root reaches (parent cycles) so every later pass is acyclic
+    tree_parent = np.where(reached, parent_row, -1)
+
+    # Preorder index within the subtree: a child sits after its parent and the
+    # whole subtrees of its earlier (lower row) siblings.
+    size = subtree_sizes(tree_parent)
+    child_size = size[indices]
+    before = np.cumsum(child_size) - child_size
+    first_sibling = indptr[parent_row[indices]]
+    offset = np.zeros(n, dtype=np.int64)
+    offset[indices] = 1 + before - before[first_sibling]
+    _, preorder, _ = climb_to_roots(tree_parent, offset, n.bit_length() + 1)
+
+    rows = np.flatnonzero(reached)
+    members = rows[np.lexsort((preorder[rows], depth[rows], root_of[rows]))].astype(np.int32)
+    root_indptr = np.searchsorted(root_of[members], np.arange(len(roots) + 1)).astype(np.int64)
+    return root_of, root_indptr, members
+
+def subtree_bounds(
+    xyz: np.ndarray, root_indptr: np.ndarray, members: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Axis aligned bounding box of every root's subtree. fmin/fmax skip nan
+    # coordinates, which can never fall inside a cube.
+    if len(root_indptr) < 2:
+        return np.empty((0, 3)), np.empty((0, 3))
+    pts = xyz[members]
+    lo = np.fmin.reduceat(pts, root_indptr[:-1], axis=0)
+    hi = np.fmax.reduceat(pts, root_indptr[:-1], axis=0)
+    return lo, hi
+
+def format_swc_for_root(
+    xyz: np.ndarray,
+    r: np.ndarray,
+    parent_row: np.ndarray,
+    order: np.ndarray,
+    remap: np.ndarray,
     root_type: int = 1,
     neurite_type: int = 0,
-):
-    subtree = extract_subtree(children, root_id)
-
-    order = []
-    q = deque([root_id])
-    seen = set()
-    while q:
-        u = q.popleft()
-        if u in seen:
-            continue
-        seen.add(u)
-        order.append(u)
-        for v in sorted(children.get(u, [])):
-            if v not in seen:
-                q.append(v)
-
-    for nid in subtree:
-        if nid not in seen:
-            order.append(nid)
-
-    new_id = {old: i + 1 for i, old in enumerate(order)}
-
-    with open(out_path, "w") as f:
-        f.write("# id type x y z radius parent\n")
-
-        for old in order:
-            x, y, z, r, _, parent = nodes[old]
-            swc_type = root_type if old == root_id else neurite_type
-
-            if old == root_id:
-                swc_parent = -1
-            else:
-                if parent not in new_id:
-                    swc_parent = new_id[root_id]
-                else:
-                    swc_parent = new_id[parent]
-
-            f.write(
-                f"{new_id[old]} {swc_type} {x:.4f} {y:.4f} {z:.4f} {r:.4f} {swc_parent}\n"
-            )
+) -> bytes:
+    # Renders the subtree as standalone SWC text.
+    # order is the subtree's BFS order from label_components, root first.
+    # Children are stored sorted, so it is already deterministic. remap is a
+    # row-sized buffer of -1 used to renumber nodes; it is restored on return.
+    # Every node after the root has its parent inside the subtree, so only
+    # those parents are gathered.
+    k = len(order)
+    remap[order] = np.arange(1, k + 1, dtype=np.int32)
+    swc_parent = np.empty(k, dtype=np.int32)
+    swc_parent[0] = -1
+    swc_parent[1:] = remap[parent_row[order[1:]]]
+    remap[order] = -1
+
+    rows = np.empty((k, 7), dtype=np.float64)
+    rows[:, 0] = np.arange(1, k + 1)
+    rows[:, 1] = neurite_type
+    rows[0, 1] = root_type
+    rows[:, 2:5] = xyz[order]
+    rows[:, 5] = r[order]
+    rows[:, 6] = swc_parent
+    # One %-format over the whole table renders the same text np.savetxt
+    # would, without its per-row Python loop.
+    body = ((SWC_FMT + "\n") * k) % tuple(rows.ravel().tolist())
+    return ("# id type x y z radius parent\n" + body).encode()
+
+def write_file(path: str, payload: bytes) -> None:
+    # Raw fd write, skipping the buffered/text wrappers of open()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
 
 def read_anchors_csv(path: str) -> List[Tuple[float, float, float]]:
     with open(path, newline="") as f:
@@ -143,8 +363,75 @@ def read_anchors_csv(path: str) -> List[Tuple[float, float, float]]:
 
     return anchors
 
-def in_cube(px: float, py: float, pz: float, cx: float, cy: float, cz: float, half: float) -> bool:
-    return (abs(px - cx) <= half) and (abs(py - cy) <= half) and (abs(pz - cz) <= half)
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _anchor_hits_jit(sub_idx, xyz, anchors, half, out_mask):
+        # One pass over the subtree per anchor, stopping at the first hit,
+        # without materializing any (nodes x anchors) intermediate.
+        for j in prange(anchors.shape[0]):
+            cx = anchors[j, 0]
+            cy = anchors[j, 1]
+            cz = anchors[j, 2]
+            for i in range(sub_idx.shape[0]):
+                u = sub_idx[i]
+                if (
+                    abs(xyz[u, 0] - cx) <= half
+                    and abs(xyz[u, 1] - cy) <= half
+                    and abs(xyz[u, 2] - cz) <= half
+                ):
+                    out_mask[j] = True
+                    break
+else:
+    _anchor_hits_jit = None
+
+def anchor_hits(sub_idx: np.ndarray, xyz: np.ndarray, anchors: np.ndarray, half) -> np.ndarray:
+    # Tests every subtree node against every anchor cube. Works on float
+    # coordinates or on the int32 voxel units from as_voxel_units.
+    hits = np.zeros(len(anchors), dtype=bool)
+    if _anchor_hits_jit is not None:
+        _anchor_hits_jit(sub_idx, xyz, anchors, half, hits)
+        return hits
+
+    # NumPy fallback: nodes are processed in blocks so the
+    # (nodes x anchors x 3) intermediate stays small. Anchors already hit are
+    # dropped from later blocks, and the scan stops once every anchor is hit.
+    chunk = max(1, min(HIT_BLOCK_NODES, CHUNK_BYTES // (anchors.nbytes or 1)))
+    for start in range(0, len(sub_idx), chunk):
+        if hits.all():
+            break
+        open_idx = np.flatnonzero(~hits)
+        pts = xyz[sub_idx[start:start + chunk]]
+        diff = np.abs(pts[:, None, :] - anchors[open_idx][None, :, :])
+        hits[open_idx] = (diff.max(axis=2) <= half).any(axis=0)
+    return hits
+
+def as_voxel_units(a: np.ndarray) -> Optional[np.ndarray]:
+    # int32 copy of a if every value is a whole number small enough that
+    # differences cannot overflow, otherwise None. Cube tests on the copy are
+    # exact and cheaper than on floats.
+    if a.size and (np.abs(a).max() >= 2 ** 30 or not np.array_equal(a, np.round(a))):
+        return None
+    return a.astype(np.int32)
+
+def build_anchor_grid(anchors: np.ndarray, cell_size: float) -> Dict[Tuple[int, int, int], np.ndarray]:
+    # Buckets anchor indices into a uniform grid of cubic cells
+    grid: Dict[Tuple[int, int, int], List[int]] = defaultdict(list)
+    cells = np.floor(anchors / cell_size).astype(np.int64)
+    for i, cell in enumerate(map(tuple, cells.tolist())):
+        grid[cell].append(i)
+    return {cell: np.asarray(members, dtype=np.int32) for cell, members in grid.items()}
+
+def grid_candidates(grid, cell_size: float, pts: np.ndarray) -> np.ndarray:
+    # Anchors whose cube may contain one of pts. With cells at least twice the
+    # cube half-width, a hit anchor is always in one of the 27 cells around the point.
+    # Non-finite points have no cell and cannot be inside any cube.
+    pts = pts[np.isfinite(pts).all(axis=1)]
+    cells = np.unique(np.floor(pts / cell_size).astype(np.int64), axis=0)
+    around = np.unique((cells[:, None, :] + NEIGHBOR_OFFSETS[None, :, :]).reshape(-1, 3), axis=0)
+    found = [grid[cell] for cell in map(tuple, around.tolist()) if cell in grid]
+    if not found:
+        return np.empty(0, dtype=np.int32)
+    return np.unique(np.concatenate(found))
 
 def anchor_swc_filename(sx: float, sy: float, sz: float) -> str:
     sx_i = int(round(sx))
@@ -152,6 +439,117 @@ def anchor_swc_filename(sx: float, sy: float, sz: float) -> str:
     sz_i = int(round(sz))
     return f"{sx_i}x-{sy_i}y-{sz_i}z.swc"
 
+# Per-process state read by process_root. main fills it directly for serial
+# runs; init_worker fills it from shared memory in each pool process.
+_STATE: Dict[str, object] = {}
+
+def init_state(arrays: Dict[str, np.ndarray], params: Dict[str, object]) -> None:
+    _STATE.update(arrays)
+    _STATE.update(params)
+    # Renumbering buffer shared by every root handled in this process
+    _STATE["remap"] = np.full(len(arrays["ids"]), -1, dtype=np.int32)
+    # Exports are flushed by a few threads while this process moves on to
+    # the next root; the semaphore caps how many payloads wait in memory.
+    _STATE["writer"] = ThreadPoolExecutor(max_workers=WRITE_THREADS)
+    _STATE["write_slots"] = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+    _STATE["pending_writes"] = []
+
+def share_arrays(arrays: Dict[str, np.ndarray]):
+    # Copies arrays into shared memory once so pool workers can map them
+    # instead of receiving pickled copies.
+    blocks: List[shared_memory.SharedMemory] = []
+    specs: Dict[str, Tuple[str, Tuple[int, ...], str]] = {}
+    for name, arr in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        blocks.append(shm)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        specs[name] = (shm.name, arr.shape, arr.dtype.str)
+    return blocks, specs
+
+def init_worker(specs: Dict[str, Tuple[str, Tuple[int, ...], str]], params: Dict[str, object]) -> None:
+    # Parallelism comes from the pool, so keep numba kernels single threaded.
+    if njit is not None:
+        set_num_threads(1)
+    blocks = []
+    arrays = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    init_state(arrays, params)
+    # Keeps the mappings alive for the life of the worker
+    _STATE["blocks"] = blocks
+
+def submit_write(path: str, payload: bytes) -> None:
+    slots = _STATE["write_slots"]
+    slots.acquire()
+    future = _STATE["writer"].submit(write_file, path, payload)
+    future.add_done_callback(lambda _: slots.release())
+    _STATE["pending_writes"].append(future)
+
+def process_roots(block: List[int]) -> List[int]:
+    # Runs process_root over a block of roots and returns the files written
+    # per root. All of the block's writes have finished (or raised) on return.
+    counts = [process_root(ri) for ri in block]
+    pending = _STATE["pending_writes"]
+    for future in pending:
+        future.result()
+    pending.clear()
+    return counts
+
+def process_root(ri: int) -> int:
+    # Exports roots[ri] once per anchor whose cube it reaches; returns the
+    # number of files written.
+    st = _STATE
+    xyz, anchors = st["xyz"], st["anchors"]
+    root = int(st["roots"][ri])
+
+    # Only anchors whose cube overlaps the subtree bounding box can be hit
+    box_half = st["box_half"]
+    in_box = np.all(
+        (anchors >= st["root_min"][ri] - box_half)
+        & (anchors <= st["root_max"][ri] + box_half),
+        axis=1,
+    )
+    if not in_box.any():
+        return 0
+
+    root_indptr = st["root_indptr"]
+    subtree = st["members"][root_indptr[ri]:root_indptr[ri + 1]]
+    near = grid_candidates(st["grid"], st["cell_size"], xyz[subtree])
+    near = near[in_box[near]]
+    hit_xyz = st.get("hit_xyz", xyz)
+    hit_anchors = st.get("hit_anchors", anchors)
+    hits = anchor_hits(subtree, hit_xyz, hit_anchors[near], st["hit_half"])
+    candidate_anchors = near[hits].tolist()
+    if not candidate_anchors:
+        return 0
+
+    # The export is identical for every anchor, so it is rendered once
+    payload = format_swc_for_root(xyz, st["r"], st["parent_row"], subtree, st["remap"])
+    for si in candidate_anchors:
+        out_path = os.path.join(
+            st["anchor_dirs"][si],
+            f"root_{st['ids'][root]:08d}.swc",
+        )
+        submit_write(out_path, payload)
+    return len(candidate_anchors)
+
+def report_progress(counts) -> None:
+    # For printing progress
+    assigned = 0
+    for written in counts:
+        if written:
+            assigned += written
+            if assigned % 100 == 0:
+                print(f"Written roots: {assigned}")
+
+def available_cpus() -> int:
+    # CPUs this process may run on, honouring affinity masks where supported
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--giant_swc", required=True, help="Path to raw reconstructions (giant SWC)")
@@ -159,8 +557,14 @@ def main():
     ap.add_argument("--out_dir", required=True, help="Output directory")
     ap.add_argument("--min_nodes", type=int, default=10, help="Skip roots with fewer than this many nodes")
     ap.add_argument("--cube_half", type=float, required=True, help="Half-width of the cube around each anchor")
+    ap.add_argument("--index_cache", help="Optional .npz file caching the parsed giant SWC between runs")
+    ap.add_argument("--workers", type=int, default=1, help="Worker processes used to parse large inputs and export roots (0 = all available CPUs)")
 
     args = ap.parse_args()
+    if args.workers < 0:
+        ap.error("--workers must be 0 or positive")
+    if args.workers == 0:
+        args.workers = available_cpus()
     os.makedirs(args.out_dir, exist_ok=True)
 
     anchors = read_anchors_csv(args.anchors_csv)
@@ -175,42 +579,80 @@ def main():
         os.makedirs(d, exist_ok=True)
         anchor_dirs.append(d)
 
-    nodes, children, roots = parse_giant_swc(args.giant_swc)
-
-    # For printing progress
-    assigned = 0
-    for root in roots:
-        subtree = extract_subtree(children, root)
-        # To curb stray fraegments. May remove later.
-        if len(subtree) < args.min_nodes:
-            continue
-
-        rx, ry, rz, *_ = nodes[root]
-        candidate_anchors: List[int] = []
-
-        for si, (sx, sy, sz) in enumerate(anchors):
-            hit = False
-            for nid in subtree:
-                x, y, z, *_ = nodes[nid]
-                if in_cube(x, y, z, sx, sy, sz, args.cube_half):
-                    hit = True
-                    break
-            if hit:
-                candidate_anchors.append(si)
-
-        if not candidate_anchors:
-            continue
-
-        for si in candidate_anchors:
-            out_path = os.path.join(
-            anchor_dirs[si],
-            f"root_{root:08d}.swc",
-        )
-            write_swc_for_root(out_path, nodes, children, root)
-            assigned += 1
-
-        if assigned % 100 == 0:
-            print(f"Written roots: {assigned}")
+    anchors_arr = np.asarray(anchors, dtype=np.float64)
+    ids, _, xyz, r, parent_row, indptr, indices, roots = load_swc_index(
+        args.giant_swc, args.workers, args.index_cache
+    )
+
+    _, root_indptr, members = label_components(parent_row, indptr, indices, roots)
+    sizes = np.diff(root_indptr)
+    root_min, root_max = subtree_bounds(xyz, root_indptr, members)
+    # The box test only skips work, so widen it slightly to make sure rounding
+    # never rejects an anchor the exact cube test would accept.
+    scale = max(float(np.fmax.reduce(np.abs(xyz), axis=None, initial=0.0)), float(np.abs(anchors_arr).max()))
+    box_half = args.cube_half + 1e-9 * (args.cube_half + scale)
+    cell_size = 2 * args.cube_half if args.cube_half > 0 else 1.0
+
+    arrays = {
+        "ids": ids,
+        "xyz": xyz,
+        "r": r,
+        "parent_row": parent_row,
+        "root_indptr": root_indptr,
+        "members": members,
+        "roots": roots,
+        "root_min": root_min,
+        "root_max": root_max,
+        "anchors": anchors_arr,
+    }
+    params = {
+        "anchor_dirs": anchor_dirs,
+        "grid": build_anchor_grid(anchors_arr, cell_size),
+        "cell_size": cell_size,
+        "box_half": box_half,
+    }
+    # Coordinates are often whole voxel units; then the node-level cube test
+    # runs on int32 copies instead of floats.
+    xyz_q = as_voxel_units(xyz)
+    anchors_q = as_voxel_units(anchors_arr)
+    half = args.cube_half
+    if xyz_q is not None and anchors_q is not None and float(half).is_integer() and abs(half) < 2 ** 30:
+        arrays["hit_xyz"] = xyz_q
+        arrays["hit_anchors"] = anchors_q
+        params["hit_half"] = int(half)
+    else:
+        params["hit_half"] = half
+
+    # Roots whose box misses the bounding box of all anchor cubes can never
+    # be hit; this rejects them for all roots at once.
+    anchors_lo = anchors_arr.min(axis=0) - box_half
+    anchors_hi = anchors_arr.max(axis=0) + box_half
+    overlaps = np.all((root_max >= anchors_lo) & (root_min <= anchors_hi), axis=1)
+    # To curb stray fraegments. May remove later.
+    todo = np.flatnonzero((sizes >= args.min_nodes) & overlaps).tolist()
+
+    root_blocks = [todo[i:i + ROOT_BLOCK] for i in range(0, len(todo), ROOT_BLOCK)]
+    if args.workers > 1:
+        blocks, specs = share_arrays(arrays)
+        try:
+            with ProcessPoolExecutor(
+                max_workers=args.workers,
+                initializer=init_worker,
+                initargs=(specs, params),
+            ) as pool:
+                counts = pool.map(process_roots, root_blocks)
+                report_progress(itertools.chain.from_iterable(counts))
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+    else:
+        init_state(arrays, params)
+        try:
+            counts = map(process_roots, root_blocks)
+            report_progress(itertools.chain.from_iterable(counts))
+        finally:
+            _STATE["writer"].shutdown()
 
 if __name__ == "__main__":
     main()